@@ -63,6 +63,10 @@
         )
         writer = Writer(var_re=var_re)
 
+    The patterns can also be given as strings in which case they are
+    compiled once and shared between writers.  `Writer.configure_var_re`
+    sets the rules for all writers created without `var_re`.
+
     For details about the writing process have a look at the module code.
 
     :copyright: (c) 2009 by the Jinja Team.
@@ -70,9 +74,14 @@
 """
 from __future__ import print_function
 
+import io
 import re
+import bisect
 import os
 import sys
+import threading
+from functools import lru_cache
+from types import MappingProxyType
 
 from django.template.defaulttags import CsrfTokenNode, VerbatimNode, LoremNode
 from django.templatetags.static import StaticNode
@@ -89,23 +98,221 @@ from django.templatetags import i18n as i18n_tags
 
 _node_handlers = {}
 _resolved_simple_tags = None
+_resolved_simple_tags_lock = threading.Lock()
 _newline_re = re.compile(r'(?:\r\n|\r|\n)')
+_backref_re = re.compile(r'\\[1-9]')
 
 # Django stores an itertools object on the cycle node.  Not only is this
 # thread unsafe but also a problem for the converter which needs the raw
 # string values passed to the constructor to create a jinja loop.cycle()
-# call from it.
+# call from it.  Newer Django versions already pass filter expressions
+# which are kept as they are, strings are parsed into variables once and
+# shared between all cycle nodes using them.
 _old_cycle_init = core_tags.CycleNode.__init__
+_cycle_variable_cache = {}
+
+
+def _cycle_variable(cyclevar):
+    if not isinstance(cyclevar, str):
+        return cyclevar
+    rv = _cycle_variable_cache.get(cyclevar)
+    if rv is None:
+        rv = _cycle_variable_cache[cyclevar] = Variable(cyclevar)
+    return rv
 
 
 def _fixed_cycle_init(self, cyclevars, variable_name=None, silent=False):
-    self.raw_cycle_vars = map(Variable, cyclevars)
+    self.raw_cycle_vars = [_cycle_variable(x) for x in cyclevars]
     _old_cycle_init(self, cyclevars, variable_name, silent)
 
 
 core_tags.CycleNode.__init__ = _fixed_cycle_init
 
 
+@lru_cache(maxsize=None)
+def _cached_compile(pattern):
+    return re.compile(pattern)
+
+
+def _compile_var_re(var_re):
+    """Returns the `var_re` rules as list with match and exclusion patterns
+    given as strings compiled.  Compiled patterns are used as they are.
+    """
+    rv = []
+    for reg, rep, unless in var_re:
+        if isinstance(reg, str):
+            reg = _cached_compile(reg)
+        if isinstance(unless, str):
+            unless = _cached_compile(unless)
+        rv.append((reg, rep, unless))
+    return rv
+
+
+def _combine_var_re(var_re):
+    """Combines the match patterns of a `var_re` list into a single regular
+    expression that matches if any of them matches, or returns `None` if
+    they cannot be combined safely (mixed flags, or backreferences and
+    conditional group references which would point to the wrong group in
+    the combined pattern).
+    """
+    if not var_re:
+        return None
+    flags = set(reg.flags for reg, _, _ in var_re)
+    if len(flags) != 1:
+        return None
+    sources = []
+    for reg, _, _ in var_re:
+        if _backref_re.search(reg.pattern) or '(?(' in reg.pattern:
+            return None
+        sources.append('(?:%s)' % reg.pattern)
+    try:
+        return re.compile('|'.join(sources), flags.pop())
+    except re.error:
+        return None
+
+
+def _skip_regex_class(pattern, pos):
+    """Returns the position after the character class that starts at `pos`
+    in the regular expression source `pattern`.
+    """
+    pos += 1
+    if pattern[pos:pos + 1] == '^':
+        pos += 1
+    # a closing bracket right after the opening one is literal
+    if pattern[pos:pos + 1] == ']':
+        pos += 1
+    while pos < len(pattern):
+        char = pattern[pos]
+        if char == '\\':
+            pos += 2
+            continue
+        pos += 1
+        if char == ']':
+            break
+    return pos
+
+
+def _skip_regex_group(pattern, pos):
+    """Returns the position after the group that starts at `pos` in the
+    regular expression source `pattern`.
+    """
+    depth = 0
+    while pos < len(pattern):
+        char = pattern[pos]
+        if char == '\\':
+            pos += 2
+            continue
+        if char == '[':
+            pos = _skip_regex_class(pattern, pos)
+            continue
+        pos += 1
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if depth == 0:
+                break
+    return pos
+
+
+def _required_literal(reg):
+    """Returns the longest plain string every match of the compiled regular
+    expression `reg` has to contain, or `None` if no such string is known.
+    This is used to skip patterns that cannot match without running them,
+    so for any syntax it does not understand it gives up and returns `None`.
+    """
+    if reg.flags & (re.IGNORECASE | re.VERBOSE):
+        return None
+    pattern = reg.pattern
+    # a quantifier after a comment applies to the character before it
+    if '(?#' in pattern:
+        return None
+    runs = []
+    run = []
+    pos = 0
+    while pos < len(pattern):
+        char = pattern[pos]
+        if char == '|':
+            return None
+        elif char in '*?{':
+            # the previous character is optional
+            if run:
+                run.pop()
+            runs.append(''.join(run))
+            run = []
+            if char == '{':
+                end = pattern.find('}', pos)
+                if end != -1:
+                    pos = end
+        elif char == '(':
+            runs.append(''.join(run))
+            run = []
+            pos = _skip_regex_group(pattern, pos)
+            continue
+        elif char == '[':
+            runs.append(''.join(run))
+            run = []
+            pos = _skip_regex_class(pattern, pos)
+            continue
+        elif char == '\\':
+            escaped = pattern[pos + 1:pos + 2]
+            if escaped and not escaped.isalnum():
+                run.append(escaped)
+            elif escaped and escaped in 'dwsDWSbBAZ':
+                runs.append(''.join(run))
+                run = []
+            else:
+                # character codes and other escapes are not understood
+                return None
+            pos += 2
+            continue
+        elif char in '.^$+':
+            runs.append(''.join(run))
+            run = []
+        else:
+            run.append(char)
+        pos += 1
+    runs.append(''.join(run))
+    return max(runs, key=len) or None
+
+
+def _get_simple_tag_map():
+    """Returns a read-only mapping of the dotted path of every tag function
+    in the template libraries of the django engine to its tag name.  The
+    mapping is built once, on first use.
+    """
+    global _resolved_simple_tags
+    if _resolved_simple_tags is None:
+        with _resolved_simple_tags_lock:
+            if _resolved_simple_tags is None:
+                rv = {}
+                libraries = engines['django'].engine.template_libraries
+                for library in libraries.values():
+                    for func_name, func in library.tags.items():
+                        rv['.'.join((func.__module__, func.__name__))] = \
+                            func_name
+                _resolved_simple_tags = MappingProxyType(rv)
+    return _resolved_simple_tags
+
+
+def _setting_property(name, doc):
+    """Returns a property for a writer setting that the precomputed tag
+    delimiters depend on.  Setting it recomputes them, which needs all of
+    these settings, so subclasses must not assign any of them before
+    `Writer.__init__` has run.
+    """
+    attr = '_' + name
+
+    def fget(self):
+        return getattr(self, attr)
+
+    def fset(self, value):
+        setattr(self, attr, value)
+        self._recompute_end_strings()
+
+    return property(fget, fset, doc=doc)
+
+
 def node(cls):
     def proxy(f):
         _node_handlers[cls] = f
@@ -121,44 +328,69 @@ def convert_templates(output_dir, extensions=('.html', '.txt'), writer=None,
     """
     if writer is None:
         writer = Writer()
+    extensions = tuple(extensions)
 
-    def filter_templates(files):
-        for filename in files:
-            ifilename = filename.lower()
-            for extension in extensions:
-                if ifilename.endswith(extension):
-                    yield filename
+    def find_templates(directory):
+        """Yields the path relative to `directory` and the file name of
+        every template below `directory`.
+        """
+        stack = ['']
+        while stack:
+            dirname = stack.pop()
+            # like os.walk, skip folders that are missing or unreadable
+            try:
+                entries = os.scandir(os.path.join(directory, dirname))
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        # like os.walk, don't follow symlinks to folders
+                        if not entry.is_symlink():
+                            stack.append(os.path.join(dirname, entry.name))
+                    elif entry.name.lower().endswith(extensions):
+                        yield dirname, entry.name
 
     def translate(f, loadname):
         template = loader.get_template(loadname)
         original = writer.stream
-        writer.stream = f
-        writer.body(template.template.nodelist)
-        writer.stream = original
+        # collect the output in memory and write it to the file at once,
+        # encoded in a single step.
+        writer.stream = io.StringIO()
+        try:
+            writer.body(template.template.nodelist)
+            f.write(writer.stream.getvalue().encode('utf-8'))
+        finally:
+            writer.stream = original
 
     if callback is None:
         def callback(template):
             print(template)
 
     for directory in settings.TEMPLATE_DIRS:
-        for dirname, _, files in os.walk(directory):
-            dirname = dirname[len(directory):].lstrip('/')
-            for filename in filter_templates(files):
-                source = os.path.normpath(os.path.join(dirname, filename))
-                target = os.path.join(output_dir, dirname, filename)
-                basetarget = os.path.dirname(target)
-                if not os.path.exists(basetarget):
-                    os.makedirs(basetarget)
-                callback(source)
-                f = open(target, 'w')
-                try:
-                    translate(f, source)
-                finally:
-                    f.close()
+        for dirname, filename in find_templates(directory):
+            source = os.path.normpath(os.path.join(dirname, filename))
+            target = os.path.join(output_dir, dirname, filename)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            callback(source)
+            f = open(target, 'wb')
+            try:
+                translate(f, source)
+            finally:
+                f.close()
 
 
 class Writer(object):
-    """The core writer class."""
+    """The core writer class.
+
+    The delimiter strings, `autoescape`, `spaceless` and
+    `use_jinja_autoescape` are properties that can be changed at any time,
+    but subclasses must not assign them before calling `Writer.__init__`.
+    """
+
+    #: the variable translation rules used if none are passed to the
+    #: constructor.  Use `configure_var_re` to set them.
+    default_var_re = ()
 
     def __init__(self, stream=None, error_stream=None,
                  block_start_string=BLOCK_START_STRING,
@@ -178,20 +410,32 @@ class Writer(object):
             error_stream = sys.stderr
         self.stream = stream
         self.error_stream = error_stream
-        self.block_start_string = block_start_string
-        self.block_end_string = block_end_string
-        self.variable_start_string = variable_start_string
-        self.variable_end_string = variable_end_string
+        self._block_start_string = block_start_string
+        self._block_end_string = block_end_string
+        self._variable_start_string = variable_start_string
+        self._variable_end_string = variable_end_string
         self.comment_start_string = comment_start_string
         self.comment_end_string = comment_end_string
-        self.autoescape = initial_autoescape
-        self.spaceless = False
-        self.use_jinja_autoescape = use_jinja_autoescape
+        self._autoescape = initial_autoescape
+        self._spaceless = False
+        self._use_jinja_autoescape = use_jinja_autoescape
         self.node_handlers = dict(_node_handlers,
                                   **(custom_node_handlers or {}))
         self._loop_depth = 0
-        self.var_re = var_re or []
+        if var_re is None:
+            var_re = list(self.default_var_re)
+        self.var_re = var_re
         self.env = env
+        self._simple_tag_name_cache = {}
+        self._newline_index = None
+        self._recompute_end_strings()
+
+    @classmethod
+    def configure_var_re(cls, var_re):
+        """Compiles the variable translation rules once and uses them for
+        all writers of this class that are created without `var_re`.
+        """
+        cls.default_var_re = _compile_var_re(var_re)
 
     def enter_loop(self):
         """Increments the loop depth so that write functions know if they
@@ -208,9 +452,69 @@ class Writer(object):
         """True if we are in a loop."""
         return self._loop_depth > 0
 
+    @property
+    def var_re(self):
+        """The variable translation rules.  The list can be replaced or
+        changed in place, either is picked up by the next translation.
+        """
+        return self._var_re
+
+    @var_re.setter
+    def var_re(self, value):
+        self._var_re = value
+        self._update_var_re()
+
+    def _update_var_re(self):
+        """Rebuilds the lookups derived from `var_re`."""
+        self._var_re_seen = self._var_re[:]
+        var_re = _compile_var_re(self._var_re)
+        self._combined_var_re = _combine_var_re(var_re)
+        self._var_re_prefilter = [(reg, rep, unless, _required_literal(reg))
+                                  for reg, rep, unless in var_re]
+        # translated variable names, keyed by the raw name.  The result
+        # depends on whether we are in a loop so there is one per state.
+        self._var_cache_inloop = {}
+        self._var_cache_outloop = {}
+
+    block_start_string = _setting_property(
+        'block_start_string', 'The string that starts a block.')
+    block_end_string = _setting_property(
+        'block_end_string', 'The string that ends a block.')
+    variable_start_string = _setting_property(
+        'variable_start_string', 'The string that starts a variable.')
+    variable_end_string = _setting_property(
+        'variable_end_string', 'The string that ends a variable.')
+    use_jinja_autoescape = _setting_property(
+        'use_jinja_autoescape', 'True if escaping is left to Jinja.')
+    autoescape = _setting_property(
+        'autoescape', 'True if variables are escaped.')
+    spaceless = _setting_property(
+        'spaceless', 'True if whitespace around tags is stripped.')
+
+    def _recompute_end_strings(self):
+        """Builds the strings written by the delimiter methods, including
+        the whitespace around them, from the current settings.  Called
+        whenever one of the settings they depend on changes.
+        """
+        if self._spaceless:
+            post_open, pre_close = '- ', ' -'
+        else:
+            post_open, pre_close = ' ', ' '
+        self._start_variable = self._variable_start_string + post_open
+        self._end_variable_safe = pre_close + self._variable_end_string
+        if self._autoescape and not self._use_jinja_autoescape:
+            self._end_variable_default = '|e' + self._end_variable_safe
+        else:
+            self._end_variable_default = self._end_variable_safe
+        self._start_block = self._block_start_string + post_open
+        self._end_block = pre_close + self._block_end_string
+
     def write(self, s):
         """Writes stuff to the stream."""
-        self.stream.write(force_text(s))
+        if s.__class__ is str:
+            self.stream.write(s)
+        else:
+            self.stream.write(force_text(s))
 
     def print_expr(self, expr):
         """Open a variable tag, write to the string to the stream and close."""
@@ -218,40 +522,24 @@ class Writer(object):
         self.write(expr)
         self.end_variable()
 
-    def _post_open(self):
-        if self.spaceless:
-            self.write('- ')
-        else:
-            self.write(' ')
-
-    def _pre_close(self):
-        if self.spaceless:
-            self.write(' -')
-        else:
-            self.write(' ')
-
     def start_variable(self):
         """Start a variable."""
-        self.write(self.variable_start_string)
-        self._post_open()
+        self.stream.write(self._start_variable)
 
     def end_variable(self, always_safe=False):
         """End a variable."""
-        if not always_safe and self.autoescape and \
-                not self.use_jinja_autoescape:
-            self.write('|e')
-        self._pre_close()
-        self.write(self.variable_end_string)
+        if always_safe:
+            self.stream.write(self._end_variable_safe)
+        else:
+            self.stream.write(self._end_variable_default)
 
     def start_block(self):
         """Starts a block."""
-        self.write(self.block_start_string)
-        self._post_open()
+        self.stream.write(self._start_block)
 
     def end_block(self):
         """Ends a block."""
-        self._pre_close()
-        self.write(self.block_end_string)
+        self.stream.write(self._end_block)
 
     def tag(self, name):
         """Like `print_expr` just for blocks."""
@@ -265,10 +553,11 @@ class Writer(object):
 
     def literal(self, value):
         """Writes a value as literal."""
-        value = repr(value)
-        if value[:2] in ('u"', "u'"):
-            value = value[1:]
-        self.write(value)
+        if isinstance(value, str):
+            value = value.replace('\\', '\\\\').replace("'", "\\'")
+            self.stream.write("'" + value + "'")
+        else:
+            self.stream.write(repr(value))
 
     def filters(self, filters, is_block=False):
         """Dumps a list of filters."""
@@ -307,7 +596,13 @@ class Writer(object):
         else:
             source = origin.loader(origin.loadname, origin.dirs)[0]
             name = origin.loadname
-        lineno = len(_newline_re.findall(source[:position[0]])) + 1
+        # warnings usually come in batches for the same template so the
+        # newline offsets of the last source are kept around.
+        index = self._newline_index
+        if index is None or index[0] != source:
+            offsets = [m.start() for m in _newline_re.finditer(source)]
+            index = self._newline_index = (source, offsets)
+        lineno = bisect.bisect_left(index[1], position[0]) + 1
         return name, lineno
 
     def warn(self, message, node=None):
@@ -319,10 +614,34 @@ class Writer(object):
 
     def translate_variable_name(self, var):
         """Performs variable name translation."""
-        if self.in_loop and var == 'forloop' or var.startswith('forloop.'):
-            var = var[3:]
-
-        for reg, rep, unless in self.var_re:
+        if self._var_re != self._var_re_seen:
+            self._update_var_re()
+        if self.in_loop:
+            cache = self._var_cache_inloop
+        else:
+            cache = self._var_cache_outloop
+        try:
+            return cache[var]
+        except KeyError:
+            pass
+        rv = cache[var] = self._translate_variable_name(var)
+        return rv
+
+    def _translate_variable_name(self, var):
+        if self.in_loop:
+            if var == 'forloop':
+                var = 'loop'
+            elif var.startswith('forloop.'):
+                var = 'loop' + var[7:]
+
+        # most variables match none of the patterns, a single search on
+        # the combined pattern tells us that without trying each of them.
+        if self._combined_var_re is not None and \
+                self._combined_var_re.search(var) is None:
+            return var
+        for reg, rep, unless, literal in self._var_re_prefilter:
+            if literal is not None and literal not in var:
+                continue
             no_unless = unless and unless.search(var) or True
             if reg.search(var) and no_unless:
                 var = reg.sub(rep, var)
@@ -336,30 +655,33 @@ class Writer(object):
         return getattr(filter, '_filter_name', None)
 
     def get_simple_tag_name(self, tag):
-        global _resolved_simple_tags
         from django.template.library import SimpleNode, InclusionNode
         if not isinstance(tag, (SimpleNode, InclusionNode)):
-            self.warn("Can't get tag name from an unknown tag type", node=node)
+            self.warn("Can't get tag name from an unknown tag type", node=tag)
             return
 
         target_func = tag.func
+        try:
+            return self._simple_tag_name_cache[target_func]
+        except KeyError:
+            pass
         target_name = '.'.join((target_func.__module__, target_func.__name__))
 
-        if _resolved_simple_tags is None:
-            _resolved_simple_tags = {}
-            libraries = engines['django'].engine.template_libraries
-            for library in libraries.values():
-                for func_name, func in library.tags.items():
-                    _resolved_simple_tags['.'.join((func.__module__, func.__name__))] = func_name
-
-        return _resolved_simple_tags.get(target_name)
+        rv = self._simple_tag_name_cache[target_func] = \
+            _get_simple_tag_map().get(target_name)
+        return rv
 
     def node(self, node):
-        """Invokes the node handler for a node."""
-        for cls, handler in self.node_handlers.items():
-            if type(node) is cls or type(node).__name__ == cls:
-                handler(self, node)
-                break
+        """Invokes the node handler for a node.  Handlers are looked up by
+        the exact type of the node first and by the name of the type second.
+        """
+        node_type = type(node)
+        handlers = self.node_handlers
+        handler = handlers.get(node_type)
+        if handler is None:
+            handler = handlers.get(node_type.__name__)
+        if handler is not None:
+            handler(self, node)
         else:
             self.warn('Untranslatable node %s.%s found' % (
                 node.__module__,
@@ -368,8 +690,14 @@ class Writer(object):
 
     def body(self, nodes):
         """Calls node() for every node in the iterable passed."""
+        # text nodes are the most common ones, unless the handler for them
+        # was replaced they are written without going through node().
+        fast_text = self.node_handlers.get(TextNode) is text_node
         for node in nodes:
-            self.node(node)
+            if fast_text and type(node) is TextNode:
+                self.write(node.s)
+            else:
+                self.node(node)
 
 
 @node(TextNode)
@@ -446,25 +774,30 @@ def for_loop(writer, node):
     writer.tag('endfor')
 
 
-def _if_condition_to_bits_backwards(condition):
-    from django.template.smartif import Literal, OPERATORS
-    if isinstance(condition, Literal):
-        yield condition.value
-        return
-    if condition.second:
-        yield from _if_condition_to_bits_backwards(condition.second)
-    if isinstance(condition, OPERATORS['not']):  # prefix
-        yield from _if_condition_to_bits_backwards(condition.first)
-        yield condition
-    else:
-        yield condition
-        yield from _if_condition_to_bits_backwards(condition.first)
-
-
 def if_condition_to_bits(condition):
-    backward_bits = list(_if_condition_to_bits_backwards(condition))
-    backward_bits.reverse()
-    return backward_bits
+    """Flattens a parsed if condition into the literals and operators in the
+    order they appear in the template.
+    """
+    from django.template.smartif import Literal, OPERATORS
+    bits = []
+    # pairs of a token and whether its children were already pushed
+    stack = [(condition, False)]
+    while stack:
+        condition, expanded = stack.pop()
+        if expanded:
+            bits.append(condition)
+        elif isinstance(condition, Literal):
+            bits.append(condition.value)
+        else:
+            if condition.second:
+                stack.append((condition.second, False))
+            if isinstance(condition, OPERATORS['not']):  # prefix
+                stack.append((condition.first, False))
+                stack.append((condition, True))
+            else:
+                stack.append((condition, True))
+                stack.append((condition.first, False))
+    return bits
 
 
 @node(core_tags.IfNode)
@@ -655,9 +988,12 @@ def width_ratio(writer, node):
 def with_block(writer, node):
     writer.start_block()
     writer.write('with ')
-    for x, (key, value) in enumerate(node.extra_context.items()):
-        if x:
+    need_comma = False
+    for key, value in node.extra_context.items():
+        if need_comma:
             writer.write(', ')
+        else:
+            need_comma = True
         writer.write(key)
         writer.write('=')
         writer.node(value)
@@ -733,20 +1069,29 @@ def translate_block(writer, node):
             first_var.append(name)
 
     def dump_token_list(tokens):
+        # consecutive text tokens are written in one go
+        text = []
         for token in tokens:
             if token.token_type == TOKEN_TEXT:
-                writer.write(token.contents)
+                text.append(token.contents)
             elif token.token_type == TOKEN_VAR:
+                if text:
+                    writer.write(''.join(text))
+                    del text[:]
                 writer.print_expr(token.contents)
                 touch_var(token.contents)
+        if text:
+            writer.write(''.join(text))
 
     writer.warn('i18n system used, make sure to install translations', node)
     writer.start_block()
     writer.write('trans')
-    idx = -1
-    for idx, (key, var) in enumerate(node.extra_context.items()):
-        if idx:
+    need_comma = False
+    for key, var in node.extra_context.items():
+        if need_comma:
             writer.write(',')
+        else:
+            need_comma = True
         writer.write(' %s=' % key)
         touch_var(key)
         writer.node(var.filter_expression)
@@ -757,7 +1102,7 @@ def translate_block(writer, node):
         have_plural = True
         plural_var = node.countervar
         if plural_var not in variables:
-            if idx > -1:
+            if need_comma:
                 writer.write(',')
             touch_var(plural_var)
             writer.write(' %s=' % plural_var)
@@ -802,9 +1147,12 @@ def simple_tag(writer, node):
             writer.node(var)
 
     if node.kwargs:
-        for idx, (key, val) in enumerate(node.kwargs.items()):
-            if has_args or idx:
+        need_comma = has_args
+        for key, val in node.kwargs.items():
+            if need_comma:
                 writer.write(', ')
+            else:
+                need_comma = True
             writer.write('%s=' % key)
             writer.node(val)
     writer.write(')')
@@ -836,9 +1184,12 @@ def inclusion_tag(writer, node):
             writer.node(var)
 
     if node.kwargs:
-        for idx, (key, val) in enumerate(node.kwargs.items()):
-            if has_args or idx:
+        need_comma = has_args
+        for key, val in node.kwargs.items():
+            if need_comma:
                 writer.write(', ')
+            else:
+                need_comma = True
             writer.write('%s=' % key)
             writer.node(val)
     writer.write(')')